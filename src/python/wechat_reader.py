@@ -8,14 +8,92 @@ Based on https://github.com/TC999/WeChatMsg implementation
 Supports WeChat 4.0 with database version 4.
 """
 
+import functools
 import hashlib
+import heapq
 import json
 import os
+import re
 import sqlite3
 import sys
-from typing import List, Dict, Any, Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Set, Tuple
 from dataclasses import dataclass, asdict
 from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+
+try:
+    import zstandard as zstd
+except ImportError:
+    # zstandard is optional, only needed for compressed message content
+    zstd = None
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the stdlib json module is used without it
+    orjson = None
+
+
+# Connection settings for the read-only workload: keep temp data and hot pages
+# in memory and let SQLite mmap the (often large) message databases
+SQLITE_SCHEMA_PRAGMAS = (
+    'synchronous=NORMAL',
+    'cache_size=-131072',
+    'mmap_size=1073741824',
+)
+SQLITE_CONNECTION_PRAGMAS = (
+    'temp_store=MEMORY',
+    'query_only=1',
+)
+
+# SQLite's default limit on databases attached to one connection
+MAX_ATTACHED_SHARDS = 10
+
+# How long the message database list and Msg_* table index are trusted before
+# being rebuilt; shorter than the app's 15 s monitor poll so every poll sees new rows
+TABLE_INDEX_TTL_SECONDS = 10
+
+# How get_messages resolves message senders
+SENDER_DIRECT = 'direct'  # 1:1 chat, compare real_sender_id with the user's and peer's Name2Id rowids
+SENDER_JOIN = 'join'      # LEFT JOIN Name2Id for every row
+SENDER_NONE = 'none'      # No sender information available
+
+# WeChat 4.0 message table names: Msg_ followed by the md5 hex digest of the chat username
+_TABLE_NAME_RE = re.compile(r'^Msg_[a-f0-9]{32}$')
+
+# WeChat 4.0 message database files: message_0.db, message_1.db, ...
+_MESSAGE_DB_RE = re.compile(r'^message_(\d+)\.db$')
+
+
+@functools.lru_cache(maxsize=4096)
+def msg_table_name(username: str) -> str:
+    """Get the message table name for a chat"""
+    # Generate table name from MD5 hash - this is safe as it only contains hex chars
+    return f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+
+
+def decode_message_content(content: Any, dctx: Optional['zstd.ZstdDecompressor'] = None) -> str:
+    """Decode a message_content value, decompressing zstd data when possible"""
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, bytes):
+        return ''
+    if dctx is not None:
+        try:
+            return dctx.decompress(content).decode('utf-8')
+        except zstd.ZstdError:
+            # Frames without a content size in the header need streaming mode
+            try:
+                return dctx.decompressobj().decompress(content).decode('utf-8')
+            except Exception:
+                pass
+        except Exception:
+            pass
+    # zstandard not installed or decompression failed
+    return content.decode('utf-8', errors='ignore')
 
 
 # Message types matching WeChat's internal type codes
@@ -33,6 +111,30 @@ class MessageType:
     REVOKE = 10002
 
 
+MESSAGE_TYPE_NAMES = {
+    MessageType.TEXT: 'text',
+    MessageType.IMAGE: 'image',
+    MessageType.VOICE: 'voice',
+    MessageType.CONTACT_CARD: 'contact',
+    MessageType.VIDEO: 'video',
+    MessageType.EMOJI: 'emoji',
+    MessageType.LOCATION: 'location',
+    MessageType.LINK: 'link',
+    MessageType.SYSTEM: 'system',
+    MessageType.REVOKE: 'revoke'
+}
+
+# Names for the common type codes below 256, indexed directly by msg_type
+_TYPE_NAME_LUT = tuple(MESSAGE_TYPE_NAMES.get(code, 'unknown') for code in range(256))
+
+
+def message_type_name(msg_type: int) -> str:
+    """Map a WeChat type code to its name"""
+    if type(msg_type) is int and 0 <= msg_type < 256:
+        return _TYPE_NAME_LUT[msg_type]
+    return MESSAGE_TYPE_NAMES.get(msg_type, 'unknown')
+
+
 @dataclass
 class Contact:
     """Contact/Person data model"""
@@ -56,46 +158,62 @@ class Contact:
         }
 
 
-@dataclass
-class Message:
-    """Message data model"""
-    local_id: int
-    server_id: int
-    msg_type: int
-    sender_username: str
-    create_time: int
-    content: str
-    is_sender: bool
-    talker: str
-
-    def to_dict(self, contact_map: Dict[str, str] = None) -> dict:
-        sender_name = '我' if self.is_sender else (
-            contact_map.get(self.sender_username, self.sender_username) if contact_map else self.sender_username
-        )
-        return {
-            'id': f'msg_{self.local_id}',
-            'chatId': self.talker,
-            'sender': sender_name,
-            'content': self.content or '',
-            'timestamp': self.create_time * 1000,  # Convert to milliseconds
-            'type': self._get_type_name(),
-            'isMe': self.is_sender
-        }
+# Column order of the message data returned by WeChatDatabaseV4.get_messages
+MESSAGE_COLUMNS = (
+    'local_id', 'server_id', 'msg_type', 'sender_username', 'create_time', 'content', 'is_sender'
+)
+# Messages are ordered by (create_time, local_id): create_time is in seconds, so
+# local_id breaks ties between messages sent in the same second
+_MESSAGE_ORDER_KEY = itemgetter(MESSAGE_COLUMNS.index('create_time'), MESSAGE_COLUMNS.index('local_id'))
+
+
+def message_columns(rows: List[tuple]) -> Dict[str, list]:
+    """Transpose MESSAGE_COLUMNS row tuples into parallel column lists"""
+    if not rows:
+        return {name: [] for name in MESSAGE_COLUMNS}
+    return dict(zip(MESSAGE_COLUMNS, map(list, zip(*rows))))
 
-    def _get_type_name(self) -> str:
-        types = {
-            MessageType.TEXT: 'text',
-            MessageType.IMAGE: 'image',
-            MessageType.VOICE: 'voice',
-            MessageType.CONTACT_CARD: 'contact',
-            MessageType.VIDEO: 'video',
-            MessageType.EMOJI: 'emoji',
-            MessageType.LOCATION: 'location',
-            MessageType.LINK: 'link',
-            MessageType.SYSTEM: 'system',
-            MessageType.REVOKE: 'revoke'
+
+def timestamps_ms(create_times: List[int]) -> List[int]:
+    """Convert a column of create_time seconds to milliseconds"""
+    return [create_time * 1000 for create_time in create_times]
+
+
+def iter_message_dicts(columns: Dict[str, list], talker: str,
+                       contact_map: Dict[str, str] = None) -> Iterator[dict]:
+    """
+    Get the JSON message dicts for a chat straight from message columns
+    The computed columns are built before returning, so bad rows raise here
+    rather than after write_json_array has started writing the response.
+    """
+    type_names = [message_type_name(msg_type) for msg_type in columns['msg_type']]
+    timestamps = timestamps_ms(columns['create_time'])
+    names = contact_map or {}
+    return (
+        {
+            'id': f'msg_{local_id}',
+            'chatId': talker,
+            'sender': '我' if is_sender else names.get(sender_username, sender_username),
+            'content': content or '',
+            'timestamp': timestamp,
+            'type': type_name,
+            'isMe': is_sender
         }
-        return types.get(self.msg_type, 'unknown')
+        for local_id, type_name, sender_username, timestamp, content, is_sender in zip(
+            columns['local_id'], type_names, columns['sender_username'],
+            timestamps, columns['content'], columns['is_sender'])
+    )
+
+
+@dataclass(frozen=True)
+class MessageShard:
+    """A message database: its connection and the schema name it is attached as"""
+    db: sqlite3.Connection
+    schema: str = ''
+
+    @property
+    def prefix(self) -> str:
+        return f'{self.schema}.' if self.schema else ''
 
 
 class WeChatDatabaseV4:
@@ -108,10 +226,66 @@ class WeChatDatabaseV4:
         self.db_dir = db_dir
         self.contact_db = None
         self.session_db = None
-        self.message_dbs: List[sqlite3.Connection] = []
+        self.message_dbs: List[MessageShard] = []
+        # Connection the message databases are attached to, see _add_message_db
+        self.shard_db: Optional[sqlite3.Connection] = None
+        self._message_db_paths: Set[str] = set()
+        # Msg_* table name -> message databases that contain it
+        self._table_index: Dict[str, List[MessageShard]] = {}
+        self._table_index_time = 0.0
+        # shard -> PRAGMA schema_version the table index was built from
+        self._schema_versions: Dict[MessageShard, Optional[int]] = {}
+        # (shards, table name, has start_time, has before_time) -> (message query SQL, sender modes)
+        self._stmt_cache: Dict[Tuple[Tuple[MessageShard, ...], str, bool, bool], Tuple[str, Tuple[str, ...]]] = {}
+        self._cursors: Dict[int, sqlite3.Cursor] = {}
+        # (shard, username) -> that user's Name2Id rowid in the database, once it has one
+        self._sender_ids: Dict[Tuple[MessageShard, str], Optional[int]] = {}
         self.contacts_map: Dict[str, Contact] = {}
+        # contacts_map also gets groups from get_groups(), so track people separately
+        self._contacts_loaded = False
+        # PRAGMA data_version of contact_db when contacts were last loaded
+        self._contacts_version: Optional[int] = None
+        self._contact_names: Optional[Dict[str, str]] = None
+        self._my_wxid: Optional[str] = None
         self._initialized = False
 
+    @staticmethod
+    def _open(db_path: str) -> sqlite3.Connection:
+        """Open a database connection tuned for reading"""
+        db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False,
+                             cached_statements=256)
+        db.row_factory = sqlite3.Row
+        for pragma in SQLITE_SCHEMA_PRAGMAS + SQLITE_CONNECTION_PRAGMAS:
+            db.execute(f'PRAGMA {pragma}')
+        return db
+
+    def _find_message_db_paths(self) -> List[str]:
+        """List the message_N.db files in db_dir, or else in its message/ subdirectory"""
+        message_db_paths = self._list_message_db_paths(self.db_dir)
+        if not message_db_paths:
+            message_db_paths = self._list_message_db_paths(os.path.join(self.db_dir, 'message'))
+        return message_db_paths
+
+    def _add_message_db(self, db_path: str):
+        """
+        Open a message database. The first MAX_ATTACHED_SHARDS are attached to
+        one shared connection as m0, m1, ..., so a chat spread over several of
+        them is read with a single UNION ALL query.
+        """
+        self._message_db_paths.add(db_path)
+        attached = sum(1 for shard in self.message_dbs if shard.schema)
+        if attached >= MAX_ATTACHED_SHARDS:
+            self.message_dbs.append(MessageShard(self._open(db_path)))
+            return
+
+        if self.shard_db is None:
+            self.shard_db = self._open(':memory:')
+        schema = f'm{attached}'
+        self.shard_db.execute(f'ATTACH DATABASE ? AS {schema}', (db_path,))
+        for pragma in SQLITE_SCHEMA_PRAGMAS:
+            self.shard_db.execute(f'PRAGMA {schema}.{pragma}')
+        self.message_dbs.append(MessageShard(self.shard_db, schema))
+
     def init_database(self) -> bool:
         """Initialize database connections"""
         try:
@@ -120,71 +294,45 @@ class WeChatDatabaseV4:
             flat_contact_db_path = os.path.join(self.db_dir, 'contact.db')
             
             if os.path.exists(contact_db_path):
-                self.contact_db = sqlite3.connect(contact_db_path)
-                self.contact_db.row_factory = sqlite3.Row
+                self.contact_db = self._open(contact_db_path)
             elif os.path.exists(flat_contact_db_path):
                 # Try flat structure (contact.db in root)
-                self.contact_db = sqlite3.connect(flat_contact_db_path)
-                self.contact_db.row_factory = sqlite3.Row
+                self.contact_db = self._open(flat_contact_db_path)
             else:
                 # Try alternative path (direct MicroMsg.db)
                 micromsg_path = os.path.join(self.db_dir, 'MicroMsg.db')
                 if os.path.exists(micromsg_path):
-                    self.contact_db = sqlite3.connect(micromsg_path)
-                    self.contact_db.row_factory = sqlite3.Row
+                    self.contact_db = self._open(micromsg_path)
                 else:
                     # Try Msg subdirectory
                     msg_micromsg_path = os.path.join(self.db_dir, 'Msg', 'MicroMsg.db')
                     if os.path.exists(msg_micromsg_path):
-                        self.contact_db = sqlite3.connect(msg_micromsg_path)
-                        self.contact_db.row_factory = sqlite3.Row
+                        self.contact_db = self._open(msg_micromsg_path)
 
             # Session database
             session_db_path = os.path.join(self.db_dir, 'session', 'session.db')
             flat_session_db_path = os.path.join(self.db_dir, 'session.db')
             
             if os.path.exists(session_db_path):
-                self.session_db = sqlite3.connect(session_db_path)
-                self.session_db.row_factory = sqlite3.Row
+                self.session_db = self._open(session_db_path)
             elif os.path.exists(flat_session_db_path):
-                self.session_db = sqlite3.connect(flat_session_db_path)
-                self.session_db.row_factory = sqlite3.Row
+                self.session_db = self._open(flat_session_db_path)
 
             # Message databases - WeChat 4.0 uses message_0.db, message_1.db, etc.
-            message_dir = os.path.join(self.db_dir, 'message')
-            flat_message_path_exists = False
-            
-            # Check for flat message_*.db files
-            if os.path.exists(os.path.join(self.db_dir, 'message_0.db')):
-                flat_message_path_exists = True
-                for i in range(100):
-                    msg_db_path = os.path.join(self.db_dir, f'message_{i}.db')
-                    if os.path.exists(msg_db_path):
-                        db = sqlite3.connect(msg_db_path)
-                        db.row_factory = sqlite3.Row
-                        self.message_dbs.append(db)
-                    else:
-                        break
-            
-            if not flat_message_path_exists and os.path.exists(message_dir):
-                for i in range(100):  # Check up to message_99.db
-                    msg_db_path = os.path.join(message_dir, f'message_{i}.db')
-                    if os.path.exists(msg_db_path):
-                        db = sqlite3.connect(msg_db_path)
-                        db.row_factory = sqlite3.Row
-                        self.message_dbs.append(db)
-                    else:
-                        break  # Stop when we don't find the next file
-            elif not flat_message_path_exists:
+            # Check for flat message_*.db files first, then the message/ subdirectory
+            message_db_paths = self._find_message_db_paths()
+            for msg_db_path in message_db_paths:
+                self._add_message_db(msg_db_path)
+
+            if not message_db_paths:
                 # Try MSG*.db format for older structure
                 msg_folder = os.path.join(self.db_dir, 'Msg')
                 if os.path.exists(msg_folder):
                     for filename in os.listdir(msg_folder):
                         if filename.startswith('MSG') and filename.endswith('.db'):
-                            msg_db_path = os.path.join(msg_folder, filename)
-                            db = sqlite3.connect(msg_db_path)
-                            db.row_factory = sqlite3.Row
-                            self.message_dbs.append(db)
+                            self._add_message_db(os.path.join(msg_folder, filename))
+
+            self._refresh_table_index(force=True)
 
             self._initialized = self.contact_db is not None
             return self._initialized
@@ -193,14 +341,94 @@ class WeChatDatabaseV4:
             print(f"Error initializing database: {e}", file=sys.stderr)
             return False
 
+    @staticmethod
+    def _list_message_db_paths(directory: str) -> List[str]:
+        """
+        List message_0.db, message_1.db, ... in a directory with a single scan
+        Stops at the first missing index, checking up to message_99.db
+        """
+        indexes = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    match = _MESSAGE_DB_RE.match(entry.name)
+                    if match:
+                        indexes.add(int(match.group(1)))
+        except OSError:
+            return []
+
+        paths = []
+        for i in range(100):
+            if i not in indexes:
+                break  # Stop when we don't find the next file
+            paths.append(os.path.join(directory, f'message_{i}.db'))
+        return paths
+
+    def _refresh_table_index(self, force: bool = False) -> bool:
+        """
+        Open message databases created since init and keep the Msg_* table index
+        current, checking at most once per TABLE_INDEX_TTL_SECONDS unless forced.
+        The index is only rebuilt when a database was added or its schema changed.
+        init_database forces the first build after opening the databases itself,
+        so a forced refresh does not look for new ones.
+        Returns True if the index was rebuilt.
+        """
+        now = time.monotonic()
+        if not force and now - self._table_index_time < TABLE_INDEX_TTL_SECONDS:
+            return False
+        self._table_index_time = now
+
+        if not force:
+            for db_path in self._find_message_db_paths():
+                if db_path not in self._message_db_paths:
+                    try:
+                        self._add_message_db(db_path)
+                    except sqlite3.Error as e:
+                        print(f"Error opening message database {db_path}: {e}", file=sys.stderr)
+
+        schema_versions = {shard: self._get_schema_version(shard) for shard in self.message_dbs}
+        if schema_versions == self._schema_versions:
+            return False
+        self._schema_versions = schema_versions
+
+        # Sender modes are picked from the schema
+        self._stmt_cache.clear()
+        self._table_index = {}
+        for shard in self.message_dbs:
+            self._index_message_db(shard)
+        return True
+
+    @staticmethod
+    def _get_schema_version(shard: MessageShard) -> Optional[int]:
+        """Get a message database's PRAGMA schema_version, which changes with every schema change"""
+        try:
+            return shard.db.execute(f'PRAGMA {shard.prefix}schema_version').fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def _index_message_db(self, shard: MessageShard):
+        """Record which Msg_* tables live in a message database"""
+        try:
+            cursor = shard.db.execute(
+                f"SELECT name FROM {shard.prefix}sqlite_master WHERE type='table' AND name LIKE 'Msg_%'"
+            )
+            for row in cursor:
+                self._table_index.setdefault(row['name'], []).append(shard)
+        except sqlite3.Error as e:
+            print(f"Error indexing message database {shard}: {e}", file=sys.stderr)
+
     def close(self):
         """Close all database connections"""
         if self.contact_db:
             self.contact_db.close()
         if self.session_db:
             self.session_db.close()
-        for db in self.message_dbs:
+        for db in {shard.db for shard in self.message_dbs}:
             db.close()
+        self._cursors.clear()
+        self._stmt_cache.clear()
+        self._sender_ids.clear()
+        self._schema_versions.clear()
 
     def get_contacts(self) -> List[Contact]:
         """
@@ -211,8 +439,13 @@ class WeChatDatabaseV4:
             return []
 
         contacts = []
+        self._contact_names = None
+        self._contacts_loaded = True
+        self._contacts_version = self._get_contact_db_version()
         try:
             cursor = self.contact_db.cursor()
+            # Plain tuple rows: unpacking is much cheaper than sqlite3.Row name lookups
+            cursor.row_factory = None
             
             # Try WeChat 4.0 structure first
             try:
@@ -223,17 +456,14 @@ class WeChatDatabaseV4:
                     WHERE (local_type=1 OR local_type=2 OR local_type=5)
                     ORDER BY nick_name
                 """)
-                rows = cursor.fetchall()
-                
-                for row in rows:
-                    wxid = row['username']
+                for wxid, alias, local_type, flag, remark, nick_name, small_head_url, big_head_url in cursor:
                     is_chatroom = wxid.endswith('@chatroom')
                     contact = Contact(
                         wxid=wxid,
-                        nickname=row['nick_name'] or wxid,
-                        remark=row['remark'] or row['nick_name'] or wxid,
-                        alias=row['alias'] or '',
-                        small_head_img_url=row['small_head_url'] or '',
+                        nickname=nick_name or wxid,
+                        remark=remark or nick_name or wxid,
+                        alias=alias or '',
+                        small_head_img_url=small_head_url or '',
                         is_chatroom=is_chatroom
                     )
                     contacts.append(contact)
@@ -252,16 +482,13 @@ class WeChatDatabaseV4:
                       AND UserName != 'fmessage'
                     ORDER BY NickName
                 """)
-                rows = cursor.fetchall()
-                
-                for row in rows:
-                    wxid = row['UserName']
+                for wxid, alias, nick_name, contact_type, remark in cursor:
                     is_chatroom = wxid.endswith('@chatroom')
                     contact = Contact(
                         wxid=wxid,
-                        nickname=row['NickName'] or wxid,
-                        remark=row['Remark'] or row['NickName'] or wxid,
-                        alias=row['Alias'] or '',
+                        nickname=nick_name or wxid,
+                        remark=remark or nick_name or wxid,
+                        alias=alias or '',
                         is_chatroom=is_chatroom
                     )
                     contacts.append(contact)
@@ -272,14 +499,41 @@ class WeChatDatabaseV4:
 
         return contacts
 
+    def get_contacts_map(self) -> Dict[str, str]:
+        """
+        Get a wxid -> display name map, loading contacts on first use
+        Contacts are reloaded once WeChat has written to the contact database,
+        so a long-running reader names contacts added after it started.
+        """
+        if self._contacts_loaded and self._get_contact_db_version() != self._contacts_version:
+            self._contacts_loaded = False
+            self._contact_names = None
+        if self._contact_names is None:
+            if not self._contacts_loaded:
+                self.get_contacts()
+            self._contact_names = {c.wxid: c.remark or c.nickname for c in self.contacts_map.values()}
+        return self._contact_names
+
+    def _get_contact_db_version(self) -> Optional[int]:
+        """Get contact_db's PRAGMA data_version, which changes when another connection commits"""
+        if not self.contact_db:
+            return None
+        try:
+            return self.contact_db.execute('PRAGMA data_version').fetchone()[0]
+        except sqlite3.Error:
+            return None
+
     def get_groups(self) -> List[Contact]:
         """Get all group chats (chatrooms)"""
         if not self.contact_db:
             return []
 
         groups = []
+        self._contact_names = None
         try:
             cursor = self.contact_db.cursor()
+            # Plain tuple rows: unpacking is much cheaper than sqlite3.Row name lookups
+            cursor.row_factory = None
             
             # Try WeChat 4.0 structure
             try:
@@ -290,19 +544,16 @@ class WeChatDatabaseV4:
                     WHERE c.username LIKE '%@chatroom'
                     ORDER BY c.nick_name
                 """)
-                rows = cursor.fetchall()
-                
-                for row in rows:
-                    wxid = row['username']
+                for wxid, alias, nick_name, remark, small_head_url in cursor.fetchall():
                     # Get member count from chat_room table
                     member_count = self._get_chatroom_member_count(wxid)
                     
                     group = Contact(
                         wxid=wxid,
-                        nickname=row['nick_name'] or wxid,
-                        remark=row['remark'] or row['nick_name'] or wxid,
-                        alias=row['alias'] or '',
-                        small_head_img_url=row['small_head_url'] or '',
+                        nickname=nick_name or wxid,
+                        remark=remark or nick_name or wxid,
+                        alias=alias or '',
+                        small_head_img_url=small_head_url or '',
                         is_chatroom=True,
                         member_count=member_count
                     )
@@ -317,15 +568,12 @@ class WeChatDatabaseV4:
                     WHERE UserName LIKE '%@chatroom'
                     ORDER BY NickName
                 """)
-                rows = cursor.fetchall()
-                
-                for row in rows:
-                    wxid = row['UserName']
+                for wxid, alias, nick_name, remark in cursor:
                     group = Contact(
                         wxid=wxid,
-                        nickname=row['NickName'] or wxid,
-                        remark=row['Remark'] or row['NickName'] or wxid,
-                        alias=row['Alias'] or '',
+                        nickname=nick_name or wxid,
+                        remark=remark or nick_name or wxid,
+                        alias=alias or '',
                         is_chatroom=True,
                         member_count=0
                     )
@@ -353,116 +601,261 @@ class WeChatDatabaseV4:
             pass
         return 0
 
-    def get_messages(self, username: str, limit: int = 100, offset: int = 0, start_time: int = 0) -> Tuple[List[Message], int]:
+    def get_messages(self, username: str, limit: int = 100, offset: int = 0, start_time: int = 0,
+                     before_time: int = 0, before_local_id: int = 0) -> Tuple[Dict[str, list], int]:
         """
-        Get messages for a specific chat
+        Get messages for a specific chat as parallel columns (see MESSAGE_COLUMNS)
         WeChat 4.0 uses table name format: Msg_{md5(username)}
+        For paging back through history pass the oldest message seen so far as
+        before_time (its create_time) and before_local_id with offset 0, rather than
+        a growing offset that SQLite has to skip.
+        The returned total counts the chat's rows up to one past the requested page,
+        so total > offset + limit means there are older messages.
         """
         if not self.message_dbs:
-            return [], 0
-
-        # Build contact name map
-        contact_map = {c.wxid: c.remark or c.nickname for c in self.contacts_map.values()}
+            return message_columns([]), 0
 
-        all_messages = []
-        # Generate table name from MD5 hash - this is safe as it only contains hex chars
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        table_name = msg_table_name(username)
         
         # Validate table name format to prevent SQL injection (must be Msg_ followed by 32 hex chars)
-        import re
-        if not re.match(r'^Msg_[a-f0-9]{32}$', table_name):
+        if not _TABLE_NAME_RE.match(table_name):
             print(f"Invalid table name format: {table_name}", file=sys.stderr)
-            return [], 0
+            return message_columns([]), 0
 
-        for db in self.message_dbs:
-            try:
-                cursor = db.cursor()
-                
-                # Check if table exists using parameterized query
-                cursor.execute(
-                    "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
-                    (table_name,)
-                )
-                if not cursor.fetchone():
-                    continue
-
-                # WeChat 4.0 message table structure
-                # Note: table_name is validated above to only contain safe characters
-                # Try to get messages with Name2Id join for sender info
-                try:
-                    query = f"""
-                        SELECT msg.local_id, msg.server_id, msg.local_type, 
-                               Name2Id.user_name as sender_username,
-                               msg.create_time, msg.message_content, 
-                               CASE WHEN Name2Id.user_name = ? THEN 1 ELSE 0 END as is_sender
-                        FROM {table_name} as msg
-                        LEFT JOIN Name2Id ON msg.real_sender_id = Name2Id.rowid
-                    """
-                    params = [self._get_my_wxid()]
-                    
-                    if start_time > 0:
-                        query += " WHERE msg.create_time >= ?"
-                        params.append(start_time)
-                        
-                    query += " ORDER BY msg.create_time DESC LIMIT ? OFFSET ?"
-                    params.extend([limit, offset])
-                    
-                    cursor.execute(query, params)
-                except sqlite3.OperationalError:
-                    # Fallback without Name2Id join
-                    query = f"""
-                        SELECT local_id, server_id, local_type,
-                               '' as sender_username,
-                               create_time, message_content,
-                               0 as is_sender
-                        FROM {table_name}
-                    """
-                    params = []
-                    
-                    if start_time > 0:
-                        query += " WHERE create_time >= ?"
-                        params.append(start_time)
-                        
-                    query += " ORDER BY create_time DESC LIMIT ? OFFSET ?"
-                    params.extend([limit, offset])
-                    
-                    cursor.execute(query, params)
-
-                rows = cursor.fetchall()
-
-                for row in rows:
-                    # Decompress content if needed (WeChat 4.0 uses zstd compression)
-                    content = row['message_content']
-                    if isinstance(content, bytes):
-                        try:
-                            import zstandard as zstd
-                            dctx = zstd.ZstdDecompressor()
-                            content = dctx.decompress(content).decode('utf-8')
-                        except (ImportError, Exception) as e:
-                            # zstandard not installed or decompression failed
-                            content = content.decode('utf-8', errors='ignore') if content else ''
-
-                    msg = Message(
-                        local_id=row['local_id'],
-                        server_id=row['server_id'] if row['server_id'] else 0,
-                        msg_type=row['local_type'],
-                        sender_username=row['sender_username'] or '',
-                        create_time=row['create_time'],
-                        content=content if isinstance(content, str) else '',
-                        is_sender=bool(row['is_sender']),
-                        talker=username
-                    )
-                    all_messages.append(msg)
+        # A long-running reader must also see chats that gain rows in another
+        # (possibly new) message database, so the index expires even on a hit
+        self._refresh_table_index()
 
-            except Exception as e:
-                print(f"Error getting messages from {db}: {e}", file=sys.stderr)
-                continue
+        # Only the databases that actually hold this chat's table are queried
+        shards = self._table_index.get(table_name)
+        if not shards:
+            return message_columns([]), 0
+
+        # Shards on one connection are read with one query; shards with their
+        # own connection (past MAX_ATTACHED_SHARDS) are read concurrently
+        groups: Dict[int, List[MessageShard]] = {}
+        for shard in shards:
+            groups.setdefault(id(shard.db), []).append(shard)
+
+        if len(shards) == 1:
+            # SQLite skips `offset` rows itself; one extra row tells if there are more
+            shard_limit, shard_offset = limit + 1, offset
+        else:
+            # Any shard may hold rows of the page, so each returns everything up to
+            # one past its end and the merge skips the first `offset` rows
+            shard_limit, shard_offset = offset + limit + 1, 0
 
-        # Sort by timestamp and return
-        all_messages.sort(key=lambda m: m.create_time)
-        return all_messages, len(all_messages)
+        args = (username, table_name, shard_limit, shard_offset, start_time, before_time,
+                before_local_id)
+        if len(groups) == 1:
+            shard_rows = [self._scan_shards(shards, *args)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(8, len(groups))) as executor:
+                shard_rows = list(executor.map(lambda group: self._scan_shards(group, *args),
+                                               groups.values()))
+
+        # Every shard is already newest first, so the page is a slice of the
+        # merge; return it oldest first
+        total = shard_offset + sum(len(rows) for rows in shard_rows)
+        skip = offset - shard_offset
+        merged = heapq.merge(*shard_rows, key=_MESSAGE_ORDER_KEY, reverse=True)
+        rows = list(islice(merged, skip, skip + limit))
+        rows.reverse()
+        return message_columns(rows), total
+
+    def _scan_shards(self, shards: List[MessageShard], username: str, table_name: str,
+                     limit: int, offset: int, start_time: int, before_time: int,
+                     before_local_id: int) -> List[tuple]:
+        """
+        Read a chat's rows from message databases on one connection as
+        MESSAGE_COLUMNS tuples, newest first
+        Several databases are read with one UNION ALL query, each keeping its own LIMIT/OFFSET.
+        """
+        db = shards[0].db
+        messages = []
+        try:
+            query, sender_modes = self._get_message_query(shards, username, table_name,
+                                                          start_time > 0, before_time > 0)
+            params = []
+            for shard, sender_mode in zip(shards, sender_modes):
+                params.extend(self._message_query_params(shard, username, sender_mode, limit, offset,
+                                                         start_time, before_time, before_local_id))
+
+            cursor = self._cursors.get(id(db))
+            if cursor is None:
+                cursor = self._cursors[id(db)] = db.cursor()
+            cursor.execute(query, params)
+            messages = self._read_message_rows(cursor)
+
+        except Exception as e:
+            print(f"Error getting messages from {db}: {e}", file=sys.stderr)
+
+        return messages
+
+    @staticmethod
+    def _read_message_rows(cursor: sqlite3.Cursor) -> List[tuple]:
+        """Turn message query rows into MESSAGE_COLUMNS tuples"""
+        # Decompress content if needed (WeChat 4.0 uses zstd compression).
+        # Decompressors are not thread safe, so each scan gets its own.
+        dctx = zstd.ZstdDecompressor() if zstd else None
+
+        # Rows are consumed straight off the cursor so the raw rows (and
+        # their compressed blobs) are never all held in memory at once
+        return [
+            (
+                row['local_id'],
+                row['server_id'] if row['server_id'] else 0,
+                row['local_type'],
+                row['sender_username'] or '',
+                row['create_time'],
+                decode_message_content(row['message_content'], dctx),
+                bool(row['is_sender'])
+            )
+            for row in cursor
+        ]
+
+    @staticmethod
+    def _build_message_query(table_name: str, sender_mode: str, with_start_time: bool,
+                             with_before_time: bool, schema: str = '') -> str:
+        """
+        Build the SQL for reading a chat's message table
+        sender_mode is one of SENDER_DIRECT, SENDER_JOIN or SENDER_NONE, schema
+        is the alias of an attached database holding the table, if any
+        Note: table_name must already be validated to only contain safe characters
+        """
+        prefix = f'{schema}.' if schema else ''
+        if sender_mode == SENDER_DIRECT:
+            # 1:1 chat - messages come from the user or the chat peer, so comparing
+            # real_sender_id with their two Name2Id rowids replaces the join.
+            # Other senders (e.g. system messages) get '' like an unmatched join.
+            query = f"""
+                SELECT msg.local_id, msg.server_id, msg.local_type,
+                       CASE WHEN msg.real_sender_id = ? THEN ?
+                            WHEN msg.real_sender_id = ? THEN ?
+                            ELSE '' END as sender_username,
+                       msg.create_time, msg.message_content,
+                       CASE WHEN msg.real_sender_id = ? THEN 1 ELSE 0 END as is_sender
+                FROM {prefix}{table_name} as msg
+            """
+        elif sender_mode == SENDER_JOIN:
+            # WeChat 4.0 message table structure with Name2Id join for sender info
+            query = f"""
+                SELECT msg.local_id, msg.server_id, msg.local_type, 
+                       Name2Id.user_name as sender_username,
+                       msg.create_time, msg.message_content, 
+                       CASE WHEN Name2Id.user_name = ? THEN 1 ELSE 0 END as is_sender
+                FROM {prefix}{table_name} as msg
+                LEFT JOIN {prefix}Name2Id as Name2Id ON msg.real_sender_id = Name2Id.rowid
+            """
+        else:
+            # Fallback without Name2Id join
+            query = f"""
+                SELECT local_id, server_id, local_type,
+                       '' as sender_username,
+                       create_time, message_content,
+                       0 as is_sender
+                FROM {prefix}{table_name} as msg
+            """
+
+        conditions = []
+        if with_start_time:
+            conditions.append("msg.create_time >= ?")
+        if with_before_time:
+            # (create_time, local_id) < (before_time, before_local_id), written so the
+            # create_time index still bounds the scan
+            conditions.append("msg.create_time <= ? AND (msg.create_time < ? OR msg.local_id < ?)")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        query += " ORDER BY msg.create_time DESC, msg.local_id DESC LIMIT ? OFFSET ?"
+        return query
+
+    def _get_message_query(self, shards: List[MessageShard], username: str, table_name: str,
+                           with_start_time: bool, with_before_time: bool) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Get the SQL for reading a chat from one or more message databases on one
+        connection, and the sender mode used for each database
+        The SQL text is reused across calls so sqlite3's statement cache hands
+        back the already compiled statement.
+        """
+        key = (tuple(shards), table_name, with_start_time, with_before_time)
+        cached = self._stmt_cache.get(key)
+        if cached:
+            return cached
+
+        sender_modes = tuple(self._get_sender_mode(shard, username, table_name) for shard in shards)
+        queries = [
+            self._build_message_query(table_name, sender_mode, with_start_time, with_before_time,
+                                      schema=shard.schema)
+            for shard, sender_mode in zip(shards, sender_modes)
+        ]
+        if len(queries) == 1:
+            query = queries[0]
+        else:
+            query = " UNION ALL ".join(f"SELECT * FROM ({q})" for q in queries)
+            query += " ORDER BY create_time DESC, local_id DESC"
+
+        self._stmt_cache[key] = (query, sender_modes)
+        return query, sender_modes
+
+    def _get_sender_mode(self, shard: MessageShard, username: str, table_name: str) -> str:
+        """Pick how a chat's message senders are resolved from the message database's schema"""
+        prefix = shard.prefix
+        has_name2id = shard.db.execute(
+            f"SELECT 1 FROM {prefix}sqlite_master WHERE type='table' AND name='Name2Id'"
+        ).fetchone() is not None
+        columns = {row['name'] for row in shard.db.execute(f"PRAGMA {prefix}table_info({table_name})")}
+        if not has_name2id or 'real_sender_id' not in columns:
+            # Message database without a Name2Id table or real_sender_id column
+            return SENDER_NONE
+        # Group chats need the Name2Id join to tell members apart
+        if username.endswith('@chatroom') or self._get_sender_id(shard, self._get_my_wxid()) is None:
+            return SENDER_JOIN
+        return SENDER_DIRECT
+
+    def _message_query_params(self, shard: MessageShard, username: str, sender_mode: str,
+                              limit: int, offset: int, start_time: int, before_time: int,
+                              before_local_id: int) -> list:
+        """Get the bound parameters for a query built by _build_message_query"""
+        if sender_mode == SENDER_DIRECT:
+            my_wxid = self._get_my_wxid()
+            my_sender_id = self._get_sender_id(shard, my_wxid)
+            values = [my_sender_id, my_wxid, self._get_sender_id(shard, username), username, my_sender_id]
+        elif sender_mode == SENDER_JOIN:
+            values = [self._get_my_wxid()]
+        else:
+            values = []
+        if start_time > 0:
+            values.append(start_time)
+        if before_time > 0:
+            values.extend([before_time, before_time, before_local_id])
+        values.extend([limit, offset])
+        return values
+
+    def _get_sender_id(self, shard: MessageShard, username: str) -> Optional[int]:
+        """Get a user's Name2Id rowid in a message database, if known"""
+        key = (shard, username)
+        sender_id = self._sender_ids.get(key)
+        if sender_id is None and username:
+            # Only found rowids are cached: a user gets one when their first
+            # message lands in this database, which does not change the schema
+            try:
+                row = shard.db.execute(
+                    f"SELECT rowid FROM {shard.prefix}Name2Id WHERE user_name = ?", (username,)
+                ).fetchone()
+                if row:
+                    sender_id = self._sender_ids[key] = row[0]
+            except sqlite3.Error:
+                pass
+        return sender_id
 
     def _get_my_wxid(self) -> str:
+        """Get the current user's wxid, read from info.json on first use"""
+        if self._my_wxid is None:
+            self._my_wxid = self._read_my_wxid()
+        return self._my_wxid
+
+    def _read_my_wxid(self) -> str:
         """Get the current user's wxid from info.json or database"""
         info_path = os.path.join(self.db_dir, 'info.json')
         if os.path.exists(info_path):
@@ -486,102 +879,169 @@ class WeChatDatabaseV4:
         }
 
 
-def main():
+def dumps_json(obj: Any) -> bytes:
+    """Encode obj as JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('ascii')
+
+
+def _stdout_buffer():
+    # JSON is written as bytes so the console encoding (e.g. GBK on Chinese
+    # Windows) cannot mangle non-ASCII text
+    sys.stdout.flush()
+    return sys.stdout.buffer
+
+
+def write_json(obj: Any):
+    """Write obj to stdout as one line of JSON"""
+    out = _stdout_buffer()
+    out.write(dumps_json(obj) + b'\n')
+    out.flush()
+
+
+def write_json_array(items: Iterable[Any], key: Optional[str] = None, **fields: Any):
     """
-    Main entry point for CLI usage
-    Accepts JSON commands from stdin and outputs JSON responses to stdout
+    Write items to stdout as a JSON array, encoding one item at a time so the
+    full list is never built in memory.
+    With key, writes {key: [items...], **fields} instead of a bare array.
     """
-    if len(sys.argv) < 2:
-        print(json.dumps({'error': 'Usage: wechat_reader.py <command> [args...]'}))
-        sys.exit(1)
+    out = _stdout_buffer()
+    if key is not None:
+        out.write(b'{' + dumps_json(key) + b':')
+    out.write(b'[')
+    for i, item in enumerate(items):
+        if i:
+            out.write(b',')
+        out.write(dumps_json(item))
+    out.write(b']')
+    if key is not None:
+        for name, value in fields.items():
+            out.write(b',' + dumps_json(name) + b':' + dumps_json(value))
+        out.write(b'}')
+    out.write(b'\n')
+    out.flush()
 
-    command = sys.argv[1]
-    
+
+COMMANDS = ('init', 'contacts', 'groups', 'messages', 'status', 'serve')
+
+
+def run_command(reader: WeChatDatabaseV4, ready: bool, command: str, args: List[str]) -> bool:
+    """
+    Run one command against a reader and write its JSON response to stdout
+    ready is the result of reader.init_database(), args are the command's
+    arguments after db_dir. Returns False if the command was rejected.
+    """
     if command == 'init':
-        if len(sys.argv) < 3:
-            print(json.dumps({'error': 'Missing db_dir argument'}))
-            sys.exit(1)
-        
-        db_dir = sys.argv[2]
-        reader = WeChatDatabaseV4(db_dir)
-        success = reader.init_database()
-        print(json.dumps({
-            'success': success,
+        write_json({
+            'success': ready,
             'status': reader.get_status()
-        }))
-        reader.close()
+        })
 
     elif command == 'contacts':
-        if len(sys.argv) < 3:
-            print(json.dumps({'error': 'Missing db_dir argument'}))
-            sys.exit(1)
-        
-        db_dir = sys.argv[2]
-        reader = WeChatDatabaseV4(db_dir)
-        if reader.init_database():
+        if ready:
             contacts = reader.get_contacts()
             # Filter out chatrooms for contacts list
-            contacts = [c for c in contacts if not c.is_chatroom]
-            print(json.dumps([c.to_dict() for c in contacts]))
+            write_json_array(c.to_dict() for c in contacts if not c.is_chatroom)
         else:
-            print(json.dumps([]))
-        reader.close()
+            write_json([])
 
     elif command == 'groups':
-        if len(sys.argv) < 3:
-            print(json.dumps({'error': 'Missing db_dir argument'}))
-            sys.exit(1)
-        
-        db_dir = sys.argv[2]
-        reader = WeChatDatabaseV4(db_dir)
-        if reader.init_database():
+        if ready:
             groups = reader.get_groups()
-            print(json.dumps([g.to_dict() for g in groups]))
+            write_json_array(g.to_dict() for g in groups)
         else:
-            print(json.dumps([]))
-        reader.close()
+            write_json([])
 
     elif command == 'messages':
-        if len(sys.argv) < 4:
-            print(json.dumps({'error': 'Missing arguments: db_dir, username'}))
-            sys.exit(1)
-        
-        db_dir = sys.argv[2]
-        username = sys.argv[3]
-        limit = int(sys.argv[4]) if len(sys.argv) > 4 else 100
-        offset = int(sys.argv[5]) if len(sys.argv) > 5 else 0
-        start_time = int(sys.argv[6]) if len(sys.argv) > 6 else 0
-        
-        reader = WeChatDatabaseV4(db_dir)
-        if reader.init_database():
-            reader.get_contacts()  # Load contacts for name mapping
-            reader.get_groups()
-            contact_map = {c.wxid: c.remark or c.nickname for c in reader.contacts_map.values()}
-            messages, total = reader.get_messages(username, limit, offset, start_time)
-            print(json.dumps({
-                'messages': [m.to_dict(contact_map) for m in messages],
-                'total': total,
-                'hasMore': total > offset + limit
-            }))
+        if len(args) < 1:
+            write_json({'error': 'Missing arguments: db_dir, username'})
+            return False
+
+        username = args[0]
+        limit = int(args[1]) if len(args) > 1 else 100
+        offset = int(args[2]) if len(args) > 2 else 0
+        start_time = int(args[3]) if len(args) > 3 else 0
+        before_time = int(args[4]) if len(args) > 4 else 0
+        before_local_id = int(args[5]) if len(args) > 5 else 0
+
+        if ready:
+            columns, total = reader.get_messages(username, limit, offset, start_time, before_time,
+                                                 before_local_id)
+            # Contacts are only needed to name senders other than the user
+            needs_names = any(
+                sender and not is_sender
+                for sender, is_sender in zip(columns['sender_username'], columns['is_sender'])
+            )
+            contact_map = reader.get_contacts_map() if needs_names else None
+            write_json_array(
+                iter_message_dicts(columns, username, contact_map),
+                key='messages',
+                total=total,
+                hasMore=total > offset + limit
+            )
         else:
-            print(json.dumps({'messages': [], 'total': 0, 'hasMore': False}))
-        reader.close()
+            write_json({'messages': [], 'total': 0, 'hasMore': False})
 
     elif command == 'status':
-        if len(sys.argv) < 3:
-            print(json.dumps({'error': 'Missing db_dir argument'}))
-            sys.exit(1)
-        
-        db_dir = sys.argv[2]
-        reader = WeChatDatabaseV4(db_dir)
-        reader.init_database()
-        print(json.dumps(reader.get_status()))
-        reader.close()
+        write_json(reader.get_status())
 
     else:
-        print(json.dumps({'error': f'Unknown command: {command}'}))
+        write_json({'error': f'Unknown command: {command}'})
+        return False
+
+    return True
+
+
+def serve(reader: WeChatDatabaseV4):
+    """
+    Keep the databases open and answer commands until stdin is closed
+    Each stdin line is a JSON request {"command": ..., "args": [...]} using the
+    same arguments as the CLI after db_dir; each gets exactly one JSON line back.
+    """
+    ready = reader.init_database()
+    for raw_line in sys.stdin.buffer:
+        try:
+            line = raw_line.decode('utf-8').strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            args = [str(arg) for arg in request.get('args', [])]
+            run_command(reader, ready, request.get('command'), args)
+        except Exception as e:
+            write_json({'error': str(e)})
+
+
+def main():
+    """
+    Main entry point for CLI usage
+    Outputs JSON responses to stdout; the serve command accepts JSON commands from stdin
+    """
+    if len(sys.argv) < 2:
+        write_json({'error': 'Usage: wechat_reader.py <command> [args...]'})
+        sys.exit(1)
+
+    command = sys.argv[1]
+    if command not in COMMANDS:
+        write_json({'error': f'Unknown command: {command}'})
+        sys.exit(1)
+
+    if len(sys.argv) < 3:
+        if command == 'messages':
+            write_json({'error': 'Missing arguments: db_dir, username'})
+        else:
+            write_json({'error': 'Missing db_dir argument'})
         sys.exit(1)
 
+    reader = WeChatDatabaseV4(sys.argv[2])
+    try:
+        if command == 'serve':
+            serve(reader)
+        elif not run_command(reader, reader.init_database(), command, sys.argv[3:]):
+            sys.exit(1)
+    finally:
+        reader.close()
+
 
 if __name__ == '__main__':
     main()
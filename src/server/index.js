@@ -129,8 +129,11 @@ app.get('/api/wechat/groups', async (req, res) => {
 app.get('/api/wechat/messages/:chatId', async (req, res) => {
   try {
     const { chatId } = req.params;
-    const { limit = 100, offset = 0, startTime = 0 } = req.query;
-    const messages = await wechatService.getMessages(chatId, parseInt(limit), parseInt(offset), parseInt(startTime));
+    const { limit = 100, offset = 0, startTime = 0, beforeTime = 0, beforeLocalId = 0 } = req.query;
+    const messages = await wechatService.getMessages(
+      chatId, parseInt(limit), parseInt(offset), parseInt(startTime), parseInt(beforeTime),
+      parseInt(beforeLocalId)
+    );
     res.json(messages);
   } catch (error) {
     res.status(500).json({ error: error.message });
@@ -5,6 +5,7 @@ const { spawn } = require('child_process');
 // Configuration constants
 const MONITOR_INTERVAL_MS = 15000; // Check for new messages every 15 seconds
 const SIMULATE_MESSAGE_CHANCE = 0.3; // 30% chance of generating a simulated message
+const READER_TIMEOUT_MS = 60000; // Give up on a long-running reader request after 60 seconds
 
 // Path to Python script
 const PYTHON_SCRIPT_PATH = path.join(__dirname, '..', 'python', 'wechat_reader.py');
@@ -37,6 +38,9 @@ class WeChatService {
     this.groupsCache = [];
     this.messagesCache = new Map();
     this.groupLastMessageTimes = new Map();
+
+    // Long-running Python reader (wechat_reader.py serve) for dataPath
+    this.reader = null;
   }
 
   /**
@@ -57,6 +61,8 @@ class WeChatService {
       let stdout = '';
       let stderr = '';
 
+      // Decode as a stream so multi-byte UTF-8 characters split across chunks survive
+      python.stdout.setEncoding('utf8');
       python.stdout.on('data', (data) => {
         stdout += data.toString();
       });
@@ -101,6 +107,7 @@ class WeChatService {
         let altStdout = '';
         let altStderr = '';
 
+        pythonAlt.stdout.setEncoding('utf8');
         pythonAlt.stdout.on('data', (data) => {
           altStdout += data.toString();
         });
@@ -130,6 +137,119 @@ class WeChatService {
     });
   }
 
+  /**
+   * Start a long-running Python reader that keeps the databases open
+   * and answers one JSON line per request written to its stdin
+   * @returns {object} Reader state: child process and pending requests
+   */
+  startReader() {
+    const pythonCommand = process.platform === 'win32' ? 'python' : 'python3';
+    const child = spawn(pythonCommand, [PYTHON_SCRIPT_PATH, 'serve', this.dataPath], {
+      stdio: ['pipe', 'pipe', 'pipe']
+    });
+    const reader = { process: child, pending: [], buffer: '' };
+
+    const fail = (error) => {
+      if (this.reader === reader) {
+        this.reader = null;
+      }
+      for (const request of reader.pending.splice(0)) {
+        request.reject(error);
+      }
+    };
+
+    // Responses arrive in request order, one per line
+    child.stdout.setEncoding('utf8');
+    child.stdout.on('data', (data) => {
+      reader.buffer += data;
+      let newline;
+      while ((newline = reader.buffer.indexOf('\n')) !== -1) {
+        const line = reader.buffer.slice(0, newline);
+        reader.buffer = reader.buffer.slice(newline + 1);
+        const request = reader.pending.shift();
+        if (!request) continue;
+        try {
+          request.resolve(JSON.parse(line));
+        } catch (parseError) {
+          console.error('Failed to parse Python output:', line);
+          request.reject(new Error('Failed to parse Python output'));
+        }
+      }
+    });
+
+    child.stderr.on('data', (data) => {
+      console.error('Python reader:', data.toString());
+    });
+
+    // Write errors surface through the exit/error handlers below
+    child.stdin.on('error', () => {});
+
+    child.on('error', (error) => fail(error));
+    child.on('exit', (code) => fail(new Error(`Python reader exited with code ${code}`)));
+
+    return reader;
+  }
+
+  stopReader() {
+    if (this.reader) {
+      const { process: child } = this.reader;
+      this.reader = null;
+      child.stdin.end();
+      child.kill();
+    }
+  }
+
+  /**
+   * Send a command to the long-running reader, starting it on first use
+   * @param {string} command - Command to execute
+   * @param {Array} args - Command arguments after the data path
+   * @returns {{reader: object, result: Promise<object>}} The reader the command
+   *   was sent to and its parsed JSON result
+   */
+  queryReader(command, args = []) {
+    if (!this.reader) {
+      this.reader = this.startReader();
+    }
+    const reader = this.reader;
+
+    const result = new Promise((resolve, reject) => {
+      // The request stays queued after a timeout so later responses still
+      // line up; the caller is expected to stop the hung reader
+      const timer = setTimeout(
+        () => reject(new Error(`Python reader timed out after ${READER_TIMEOUT_MS} ms`)),
+        READER_TIMEOUT_MS
+      );
+      reader.pending.push({
+        resolve: (value) => { clearTimeout(timer); resolve(value); },
+        reject: (error) => { clearTimeout(timer); reject(error); }
+      });
+      reader.process.stdin.write(JSON.stringify({ command, args }) + '\n');
+    });
+    return { reader, result };
+  }
+
+  /**
+   * Run a reader command, preferring the long-running reader and falling
+   * back to a one-shot Python process if it is unavailable
+   * @param {string} command - Command to execute
+   * @param {Array} args - Command arguments after the data path
+   * @returns {Promise<object>} Parsed JSON result
+   */
+  async readWeChat(command, args = []) {
+    const { reader, result } = this.queryReader(command, args);
+    try {
+      return await result;
+    } catch (error) {
+      console.error('Python reader error, falling back to one-shot call:', error.message);
+      // Only stop the reader this request went to: after configure() it may
+      // already have been replaced by a reader for the new data path
+      if (this.reader === reader) {
+        this.stopReader();
+      }
+      return this.executePython(command, [this.dataPath, ...args]);
+    }
+  }
+
   getStatus() {
     return {
       isConfigured: this.isConfigured,
@@ -154,10 +274,11 @@ class WeChatService {
 
     this.dataPath = dataPath;
     this.dbKey = dbKey;
+    this.stopReader();
 
     // Try to load data using Python module
     try {
-      const result = await this.executePython('init', [dataPath]);
+      const result = await this.readWeChat('init');
       
       if (result.success) {
         this.isConfigured = true;
@@ -208,7 +329,7 @@ class WeChatService {
 
     try {
       // Load contacts using Python
-      const contacts = await this.executePython('contacts', [this.dataPath]);
+      const contacts = await this.readWeChat('contacts');
       if (Array.isArray(contacts) && contacts.length > 0) {
         this.contactsCache = contacts;
       } else {
@@ -216,7 +337,7 @@ class WeChatService {
       }
 
       // Load groups using Python
-      const groups = await this.executePython('groups', [this.dataPath]);
+      const groups = await this.readWeChat('groups');
       if (Array.isArray(groups) && groups.length > 0) {
         this.groupsCache = groups;
       } else {
@@ -258,7 +379,7 @@ class WeChatService {
     // Refresh from database if cache is empty
     if (this.contactsCache.length === 0) {
       try {
-        const contacts = await this.executePython('contacts', [this.dataPath]);
+        const contacts = await this.readWeChat('contacts');
         if (Array.isArray(contacts) && contacts.length > 0) {
           this.contactsCache = contacts;
         }
@@ -278,7 +399,7 @@ class WeChatService {
     // Refresh from database if cache is empty
     if (this.groupsCache.length === 0) {
       try {
-        const groups = await this.executePython('groups', [this.dataPath]);
+        const groups = await this.readWeChat('groups');
         if (Array.isArray(groups) && groups.length > 0) {
           this.groupsCache = groups;
         }
@@ -290,7 +411,7 @@ class WeChatService {
     return this.groupsCache;
   }
 
-  async getMessages(chatId, limit = 100, offset = 0, startTime = 0) {
+  async getMessages(chatId, limit = 100, offset = 0, startTime = 0, beforeTime = 0, beforeLocalId = 0) {
     if (!this.isConfigured) {
       const sampleMessages = this.generateSampleMessages(chatId, limit);
       return {
@@ -301,12 +422,13 @@ class WeChatService {
     }
 
     try {
-      const result = await this.executePython('messages', [
-        this.dataPath,
+      const result = await this.readWeChat('messages', [
         chatId,
         String(limit),
         String(offset),
-        String(startTime)
+        String(startTime),
+        String(beforeTime),
+        String(beforeLocalId)
       ]);
 
       if (result && Array.isArray(result.messages)) {
@@ -402,8 +524,7 @@ class WeChatService {
     for (const groupId of groupIds) {
       try {
         // Get latest messages
-        const result = await this.executePython('messages', [
-          this.dataPath,
+        const result = await this.readWeChat('messages', [
           groupId,
           '10',  // Get last 10 messages
           '0'